@@ -1,28 +0,0 @@
-# FILE: /[project-name]/[project-name]/src/test_app.py
-import unittest
-from unittest.mock import patch
-from app import app  # Assuming app.py contains the Flask application
-
-class TestApp(unittest.TestCase):
-    def setUp(self):
-        self.app = app.test_client()
-        self.app.testing = True
-
-    @patch('app.start_background_task')  # Mocking the background task
-    def test_some_functionality(self, mock_start_background_task):
-        response = self.app.post('/some-endpoint', data={
-            'source_key': 'source_key',
-            'source_database_name': 'source_database_name',
-            'source_container_name': 'source_container_name',
-            'destination_endpoint': 'destination_endpoint',
-            'destination_key': 'destination_key',
-            'destination_database_name': 'destination_database_name',
-            'destination_container_name': 'destination_container_name',
-            'batch_size': '5'
-        })
-        self.assertEqual(response.status_code, 200)
-        self.assertIn(b'<form', response.data)
-        mock_start_background_task.assert_called()
-
-if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
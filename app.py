@@ -1,91 +1,156 @@
+# Patch the standard library before anything else is imported so blocking I/O in the
+# background migration task yields to other requests and socket connections
+from gevent import monkey
+monkey.patch_all()
+
 from flask import Flask, request, render_template
 from flask_socketio import SocketIO
+from werkzeug.exceptions import BadRequest, Conflict
+import asyncio
 import logging
+import threading
 import time
-from cosmos_data_migration import get_cosmos_client, get_container, count_items, migrate_data
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from cosmos_data_migration import configure_logging, get_cosmos_client, get_container, fast_count, count_items, find_missing_items
+from cosmos_data_migration_async import get_aio_client, get_aio_container, migrate_data as migrate_data_async
+import fast_json
 import os
 
 # Initialize Flask app and SocketIO
 app = Flask(__name__)
-socketio = SocketIO(app)
-
-# Ensure the log directory exists
-log_directory = os.path.dirname(os.path.abspath('migration.log'))
-if not os.path.exists(log_directory):
-    os.makedirs(log_directory)
-
-# Configure logging to log to both a file and the console
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s %(levelname)s:%(message)s',
-    handlers=[
-        logging.FileHandler('migration.log'),
-        logging.StreamHandler()
-    ]
-)
+socketio = SocketIO(app, async_mode='gevent')
+
+# Configure logging to log to both a file and the console through a background listener
+configure_logging(logging.INFO)
+root_logger = logging.getLogger()
 
 logging.info("Logging is configured.")
 
+# Serialize request bodies with orjson when it is installed
+if fast_json.install():
+    logging.info("Using orjson to serialize request bodies.")
+
+# Minimum number of seconds between progress updates sent to the client
+EMIT_INTERVAL = 0.25
+
+@dataclass
+class MigrationStatus:
+    """
+    Migration state shared between the request handlers and the background tasks.
+    Writes go through update() so readers never see a half-applied change.
+    """
+    progress: str = ''
+    errors: str = ''
+    validation: str = ''
+    source_config: dict = field(default_factory=dict)
+    destination_config: dict = field(default_factory=dict)
+    source_count: int = 0
+    not_migrated_items: list = field(default_factory=list)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def update(self, **fields):
+        """
+        Set the given fields under the status lock.
+        """
+        with self.lock:
+            for name, value in fields.items():
+                setattr(self, name, value)
+
 # Global variable to store migration status
-migration_status = {
-    'progress': '',
-    'errors': '',
-    'validation': '',
-    'source_config': {},
-    'destination_config': {},
-    'source_count': 0,
-    'not_migrated_items': []
-}
+migration_status = MigrationStatus()
+
+# Held while a migration runs. Background tasks share one OS thread under gevent, so a
+# second asyncio.run() would fail, and migration_status only describes one migration.
+migration_lock = threading.Lock()
+
+@contextmanager
+def corked():
+    """
+    Collect the fields of several updates and send them to the client as a single
+    'update' event when the block exits. Setting a field twice keeps the latest value.
+    """
+    update = {}
+    yield update
+    if update:
+        socketio.emit('update', update)
+
+def loggable(config):
+    """
+    Return a copy of a Cosmos DB configuration without its key, safe to log.
+    """
+    return {k: v for k, v in config.items() if k != 'key'}
 
 # Route for the main page
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
         # Get form data for source and destination configurations
-        source_config = {
-            'endpoint': request.form['source_endpoint'],
-            'key': request.form['source_key'],
-            'database_name': request.form['source_database_name'],
-            'container_name': request.form['source_container_name']
-        }
-        destination_config = {
-            'endpoint': request.form['destination_endpoint'],
-            'key': request.form['destination_key'],
-            'database_name': request.form['destination_database_name'],
-            'container_name': request.form['destination_container_name']
-        }
-        batch_size = int(request.form['batch_size'])
+        form = request.form.to_dict()
+        try:
+            source_config = {
+                'endpoint': form['source_endpoint'],
+                'key': form['source_key'],
+                'database_name': form['source_database_name'],
+                'container_name': form['source_container_name']
+            }
+            destination_config = {
+                'endpoint': form['destination_endpoint'],
+                'key': form['destination_key'],
+                'database_name': form['destination_database_name'],
+                'container_name': form['destination_container_name']
+            }
+            batch_size = int(form['batch_size'])
+            # A blank target means no limit
+            target_ru_per_sec = int(form['target_ru_per_sec']) if form.get('target_ru_per_sec') else None
+        except KeyError as e:
+            raise BadRequest(f"Missing form field: {e}")
+        except ValueError as e:
+            raise BadRequest(f"Invalid number in form: {e}")
+        if batch_size <= 0:
+            raise BadRequest("Batch size must be a positive number.")
+        if target_ru_per_sec is not None and target_ru_per_sec <= 0:
+            raise BadRequest("Target RU/s must be a positive number, or left blank for no limit.")
 
         # Log form data (excluding keys for security)
-        source_config_log = {k: v for k, v in source_config.items() if k != 'key'}
-        destination_config_log = {k: v for k, v in destination_config.items() if k != 'key'}
-        logging.info(f"Source Config: {source_config_log}")
-        logging.info(f"Destination Config: {destination_config_log}")
+        logging.info(f"Source Config: {loggable(source_config)}")
+        logging.info(f"Destination Config: {loggable(destination_config)}")
         logging.info(f"Batch Size: {batch_size}")
+        logging.info(f"Target RU/s: {target_ru_per_sec or 'unlimited'}")
+
+        if migration_lock.locked():
+            raise Conflict("A migration is already running. Wait for it to finish before starting another.")
 
         # Store the configurations in the global status
-        migration_status['source_config'] = source_config
-        migration_status['destination_config'] = destination_config
+        migration_status.update(source_config=source_config, destination_config=destination_config)
 
         # Start the migration in a background task
-        socketio.start_background_task(migrate, source_config, destination_config, batch_size)
+        socketio.start_background_task(migrate, source_config, destination_config, batch_size, target_ru_per_sec)
 
         return render_template('index.html')
 
     return render_template('index.html')
 
-def migrate(source_config, destination_config, batch_size):
+def migrate(source_config, destination_config, batch_size, target_ru_per_sec=None):
     """
     Migrate data from a source Cosmos DB container to a destination Cosmos DB container.
     Args:
         source_config (dict): Configuration for the source Cosmos DB, including 'database_name' and 'container_name'.
         destination_config (dict): Configuration for the destination Cosmos DB, including 'database_name' and 'container_name'.
         batch_size (int): Number of items to migrate in each batch.
+        target_ru_per_sec (int, optional): Request unit budget per second for the writes; unlimited if None.
+    Only one migration runs at a time; if another is running, an error is emitted instead.
     Emits:
         'update' (dict): Emits progress updates and errors via socketio.
     Raises:
         Exception: If an error occurs during migration.
     """
+    if not migration_lock.acquire(blocking=False):
+        error = "A migration is already running. Wait for it to finish before starting another."
+        logging.error(error)
+        migration_status.update(errors=error)
+        socketio.emit('update', {'errors': error})
+        return
     try:
         # Initialize clients and containers for both source and destination Cosmos DB
         source_client = get_cosmos_client(source_config)
@@ -95,74 +160,135 @@ def migrate(source_config, destination_config, batch_size):
         destination_container = get_container(destination_client, destination_config['database_name'], destination_config['container_name'])
 
         # Count the number of items in the source container and log the count
-        source_count = count_items(source_container)
+        source_count = fast_count(source_container)
         logging.info(f"Number of items in source container: {source_count}")
-        migration_status['source_count'] = source_count
-        migration_status['progress'] = f"Number of items in source container: {source_count}"
+        migration_status.update(source_count=source_count, progress=f"Number of items in source container: {source_count}")
         socketio.emit('update', {
-            'progress': migration_status['progress'],
-            'source_config': migration_status['source_config'],
-            'destination_config': migration_status['destination_config'],
-            'source_count': migration_status['source_count']
+            'progress': migration_status.progress,
+            'source_config': migration_status.source_config,
+            'destination_config': migration_status.destination_config,
+            'source_count': migration_status.source_count
         })
 
         # Start the migration process
-        start_time = time.time()
-        not_migrated_items = []
-        for i, item in enumerate(migrate_data(source_container, destination_container, batch_size)):
-            elapsed_time = time.time() - start_time
-            items_per_second = (i + 1) / elapsed_time
-            progress = f"Migrating items: {i + 1}it [{elapsed_time:.2f}s, {items_per_second:.2f}it/s]"
-            progress_percentage = ((i + 1) / source_count) * 100
-            logging.info(progress)
-            migration_status['progress'] = progress
-            socketio.emit('update', {'progress': migration_status['progress'], 'progress_percentage': progress_percentage})
-            if item not in not_migrated_items:
-                not_migrated_items.append(item)
-                
+        start_time = time.monotonic()
+        migrated, not_migrated = asyncio.run(
+            migrate_items(source_config, destination_config, batch_size, target_ru_per_sec, source_count, start_time)
+        )
+
         # Calculate and log the total duration of the migration
-        end_time = time.time()
+        end_time = time.monotonic()
         duration = end_time - start_time
-        final_progress = f"Data migration completed successfully in {duration:.2f} seconds. {source_count} items migrated."
+        final_progress = f"Data migration completed successfully in {duration:.2f} seconds. {migrated} items migrated, {not_migrated} already existed."
         logging.info(final_progress)
-        migration_status['progress'] = final_progress
-        socketio.emit('update', {'progress': migration_status['progress'], 'progress_percentage': 100})
+        migration_status.update(progress=final_progress)
+        socketio.emit('update', {'progress': final_progress, 'progress_percentage': 100})
 
-        # Start validation in a separate background task
-        socketio.start_background_task(validate_data, source_container, destination_container)
+        # Start validation in a separate background task; every source item read should now be in the destination
+        socketio.start_background_task(validate_data, source_container, destination_container, migrated + not_migrated)
     except Exception as e:
         logging.error(f"Error during migration: {e}")
-        migration_status['errors'] = str(e)
-        socketio.emit('update', {'errors': migration_status['errors']})
+        migration_status.update(errors=str(e))
+        socketio.emit('update', {'errors': migration_status.errors})
+    finally:
+        migration_lock.release()
 
-def validate_data(source_container, destination_container):
+async def migrate_items(source_config, destination_config, batch_size, target_ru_per_sec, source_count, start_time):
     """
-    Validate the migrated data by comparing item counts in source and destination containers.
+    Copy the items with the asynchronous Cosmos DB client, emitting progress as writes complete.
+    Args:
+        source_config (dict): Configuration for the source Cosmos DB.
+        destination_config (dict): Configuration for the destination Cosmos DB.
+        batch_size (int): Number of items to read from the source in each page.
+        target_ru_per_sec (int): Request unit budget per second for the writes; unlimited if None.
+        source_count (int): Number of items in the source container, used for the progress percentage.
+        start_time (float): time.monotonic() value when the migration started, used for the progress rate.
+    Returns:
+        tuple: The number of items migrated and the number that already existed in the destination.
+    """
+    async with get_aio_client(source_config) as source_client, get_aio_client(destination_config) as destination_client:
+        source_container = get_aio_container(source_client, source_config['database_name'], source_config['container_name'])
+        destination_container = get_aio_container(destination_client, destination_config['database_name'], destination_config['container_name'])
+
+        # Only emit when EMIT_INTERVAL has passed or another 1% of the items completed,
+        # so a large migration does not push one WebSocket frame per item
+        last_emit = 0.0
+        emit_step = max(1, source_count // 100)
+        next_emit_at = 0
+        # Reused for every progress emit instead of building a new dict per update
+        payload = {'progress': None, 'progress_percentage': None}
+        # Local aliases avoid repeated global and attribute lookups in the per-item loop
+        t0 = start_time
+        monotonic = time.monotonic
+        emit = socketio.emit
+        done = 0
+        migrated = 0
+        async for _, item_migrated in migrate_data_async(source_container, destination_container, batch_size, target_ru_per_sec):
+            done += 1
+            if item_migrated:
+                migrated += 1
+            now = monotonic()
+            if now - last_emit >= EMIT_INTERVAL or done >= next_emit_at:
+                elapsed_time = now - t0
+                items_per_second = done / elapsed_time if elapsed_time else 0.0
+                progress = f"Migrating items: {done}it [{elapsed_time:.2f}s, {items_per_second:.2f}it/s]"
+                # Integer percentage; the count may lag behind writes, so never pass 100
+                progress_percentage = min(done * 100 // source_count, 100) if source_count else 100
+                if root_logger.isEnabledFor(logging.INFO):
+                    logging.info(progress)
+                migration_status.update(progress=progress)
+                payload['progress'] = progress
+                payload['progress_percentage'] = progress_percentage
+                emit('update', payload)
+                last_emit = now
+                next_emit_at = done + emit_step
+        return migrated, done - migrated
+
+def validate_data(source_container, destination_container, expected_count):
+    """
+    Validate the migrated data by counting the destination container and comparing the count with the
+    number of source items the migration handled. Only the destination is queried; the source is not
+    read again. If the counts differ, e.g. because an item is missing or the destination held other
+    items before the migration, every source item is looked up in the destination by id and partition
+    key to list the missing ones. Source keys are checked in chunks, so memory stays bounded.
     Args:
         source_container: The source Cosmos DB container.
         destination_container: The destination Cosmos DB container.
+        expected_count (int): Number of source items migrated or found to exist already.
     Emits:
-        'update' (dict): Emits validation results and errors via socketio.
+        'update' (dict): Emits validation results, the items missing from the destination and errors via socketio.
     """
     try:
-        # Count items in both source and destination containers
-        source_count = count_items(source_container)
         destination_count = count_items(destination_container)
-        if source_count != destination_count:
-            validation_message = f"Data verification failed. Source has {source_count} items, but destination has {destination_count} items."
+        if destination_count == expected_count:
+            checked, missing, missing_keys = expected_count, 0, []
+        else:
+            logging.info(f"Destination holds {destination_count} items, expected {expected_count}; looking for missing items")
+            checked, missing, missing_keys = find_missing_items(source_container, destination_container)
+        not_migrated_items = [
+            {'id': item_id, 'partition_key': [component[1] if component else None for component in partition_key]}
+            for item_id, partition_key in missing_keys
+        ]
+        if missing:
+            validation_message = f"Data verification failed. {missing} of {checked} source items are missing from the destination."
+            if missing > len(missing_keys):
+                validation_message += f" The first {len(missing_keys)} are listed."
             logging.error(validation_message)
-            migration_status['validation'] = validation_message
         else:
             validation_message = "Data verification successful."
             logging.info(validation_message)
-            migration_status['validation'] = validation_message
-        socketio.emit('update', {'validation': migration_status['validation']})
-        socketio.emit('update', {'not_migrated_items': migration_status['not_migrated_items']})
+        migration_status.update(validation=validation_message, not_migrated_items=not_migrated_items)
+        with corked() as update:
+            update['validation'] = migration_status.validation
+            update['not_migrated_items'] = migration_status.not_migrated_items
     except Exception as e:
         logging.error(f"Error during validation: {e}")
-        migration_status['errors'] = str(e)
-        socketio.emit('update', {'errors': migration_status['errors']})
+        migration_status.update(errors=str(e))
+        socketio.emit('update', {'errors': migration_status.errors})
 
 # Run the Flask app with SocketIO
 if __name__ == '__main__':
-    socketio.run(app, debug=True)
\ No newline at end of file
+    # Debug mode is opt-in; the reloader stays off because it polls every module for changes
+    debug = os.environ.get('FLASK_DEBUG', '').lower() in ('1', 'true', 'yes')
+    logging.info(f"Starting server with debug={'on' if debug else 'off'}")
+    socketio.run(app, debug=debug, use_reloader=False)
\ No newline at end of file
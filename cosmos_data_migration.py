@@ -1,29 +1,50 @@
 import os
+import atexit
 import json
+import functools
 import time
 import logging
 import argparse
-from azure.cosmos import CosmosClient, PartitionKey
-from azure.cosmos.exceptions import CosmosResourceExistsError, CosmosHttpResponseError
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from azure.core.pipeline.transport import RequestsTransport
+from azure.cosmos import CosmosClient
+from azure.cosmos.documents import ConnectionPolicy
+from azure.cosmos.exceptions import CosmosResourceExistsError, CosmosHttpResponseError, CosmosBatchOperationError
 from dotenv import load_dotenv
-from tqdm import tqdm
-from tenacity import retry, stop_after_attempt, wait_exponential
-from azure.cosmos.exceptions import CosmosHttpResponseError
-
-# Ensure the log directory exists
-log_directory = os.path.dirname(os.path.abspath('migration.log'))
-if not os.path.exists(log_directory):
-    os.makedirs(log_directory)
-
-# Configure logging
-logging.basicConfig(
-    level=logging.ERROR,
-    format='%(asctime)s %(levelname)s:%(message)s',
-    handlers=[
-        logging.FileHandler('migration.log'),
-        logging.StreamHandler()
-    ]
-)
+import fast_json
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+
+# Listener writing queued log records to migration.log and the console
+_log_listener = None
+
+def configure_logging(level):
+    """
+    Log to both migration.log and the console. Records are queued and written by a
+    listener thread so logging calls never block on file or console I/O.
+    Calling it again only changes the level of the root logger.
+    """
+    global _log_listener
+    root_logger = logging.getLogger()
+    if _log_listener is None:
+        # Ensure the log directory exists
+        os.makedirs(os.path.dirname(os.path.abspath('migration.log')), exist_ok=True)
+        log_formatter = logging.Formatter('%(asctime)s %(levelname)s:%(message)s')
+        file_handler = logging.FileHandler('migration.log')
+        file_handler.setFormatter(log_formatter)
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(log_formatter)
+        log_queue = queue.Queue(-1)
+        _log_listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+        _log_listener.start()
+        atexit.register(_log_listener.stop)
+        root_logger.handlers = [QueueHandler(log_queue)]
+    root_logger.setLevel(level)
 
 # Load environment variables from .env file
 load_dotenv()
@@ -43,27 +64,296 @@ destination_config = {
     'container_name': os.getenv('DESTINATION_CONTAINER_NAME')
 }
 
+# Bounds for the number of writer threads used by migrate_data
+MIN_WORKERS = 4
+MAX_WORKERS = 256
+
+# Number of writer threads if the destination's provisioned throughput cannot be read
+DEFAULT_WORKERS = 64
+
+# Estimated request charge (RU) of one create_item, used to size the writer pool
+WRITE_REQUEST_CHARGE = 10
+
+# Page size used when reading item ids; the query default of 100 would need N/100 round trips
+ID_PAGE_SIZE = 10000
+
+# Number of source item ids checked against the destination per existence query
+EXISTENCE_CHECK_SIZE = 1000
+
+# Maximum number of operations in a transactional batch, a service limit
+MAX_BATCH_OPERATIONS = 100
+
+# Number of items the migration holds while grouping them by partition key
+MAX_GROUPED_ITEMS = 1000
+
+# Maximum number of missing items listed by find_missing_items; all of them are counted
+MAX_REPORTED_MISSING_ITEMS = 1000
+
+# Number of not-migrated item ids buffered before they are written to not_migrated_items.txt
+NOT_MIGRATED_FLUSH_SIZE = 1000
+
+# Seconds between progress log lines written by migrate_data
+PROGRESS_LOG_INTERVAL = 1.0
+
+# Seconds a count_items result is reused for the same container
+COUNT_CACHE_TTL = 60
+
+# Seconds before a request to Cosmos DB times out
+REQUEST_TIMEOUT = 30
+
+def get_connection_policy():
+    """
+    Return the connection policy shared by the synchronous and asynchronous clients.
+    """
+    policy = ConnectionPolicy()
+    policy.RequestTimeout = REQUEST_TIMEOUT
+    return policy
+
+def get_transport(max_connections=MAX_WORKERS):
+    """
+    Return an HTTP transport whose connection pool keeps up to max_connections
+    connections per host instead of the requests default of 10, so every writer thread
+    reuses a connection rather than opening and discarding one per request.
+    """
+    session = requests.Session()
+    # Retries are left to the SDK's own retry policies, as in azure-core's default session
+    adapter = HTTPAdapter(pool_maxsize=max_connections, max_retries=Retry(total=False, redirect=False, raise_on_status=False))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return RequestsTransport(session=session, session_owner=True)
+
+@functools.lru_cache(maxsize=16)
+def _client(endpoint, key):
+    return CosmosClient(endpoint, key, connection_policy=get_connection_policy(), transport=get_transport())
+
+@functools.lru_cache(maxsize=64)
+def _container(client, database_name, container_name):
+    database = client.get_database_client(database_name)
+    return database.get_container_client(container_name)
+
 def get_cosmos_client(config):
     """
-    Create and return a CosmosClient instance using the provided configuration.
+    Return a CosmosClient instance for the provided configuration.
+    Clients are cached per endpoint and key so repeated migrations reuse warm connections.
     """
-    return CosmosClient(config['endpoint'], config['key'])
+    return _client(config['endpoint'], config['key'])
 
 def get_container(client, database_name, container_name):
     """
     Get a container from the specified database.
+    Container proxies are cached per client, database and container name.
     """
-    database = client.get_database_client(database_name)
-    container = database.get_container_client(container_name)
-    return container
+    return _container(client, database_name, container_name)
+
+# Container link -> (expiry time, item count), the counts currently being queried, and
+# how often each container's count was invalidated by forget_count
+_count_cache = {}
+_count_in_flight = {}
+_count_generation = {}
+_count_lock = threading.Lock()
 
 def count_items(container):
     """
     Count the number of items in the specified container.
+    Counts are reused for COUNT_CACHE_TTL seconds, and concurrent calls for the same
+    container wait for a single query instead of each running their own. Writers call
+    forget_count so a container's count is never served from before its writes.
+    """
+    key = container.container_link
+    while True:
+        with _count_lock:
+            cached = _count_cache.get(key)
+            if cached and cached[0] > time.monotonic():
+                return cached[1]
+            in_flight = _count_in_flight.get(key)
+            if in_flight is None:
+                in_flight = _count_in_flight[key] = threading.Event()
+                generation = _count_generation.get(key, 0)
+                break
+        # Another caller is counting; use its result, or take over if it failed
+        in_flight.wait()
+    try:
+        query = "SELECT VALUE COUNT(1) FROM c"
+        items = list(container.query_items(query=query, enable_cross_partition_query=True))
+        count = items[0] if items else 0
+        with _count_lock:
+            now = time.monotonic()
+            for expired in [k for k, (expires_at, _) in _count_cache.items() if expires_at <= now]:
+                del _count_cache[expired]
+            # A count that raced with writes is returned but not cached
+            if _count_generation.get(key, 0) == generation:
+                _count_cache[key] = (now + COUNT_CACHE_TTL, count)
+        return count
+    finally:
+        with _count_lock:
+            del _count_in_flight[key]
+        in_flight.set()
+
+def forget_count(container):
+    """
+    Drop the cached count of a container after items were written to it.
+    """
+    with _count_lock:
+        key = container.container_link
+        _count_cache.pop(key, None)
+        _count_generation[key] = _count_generation.get(key, 0) + 1
+
+def fast_count(container):
+    """
+    Return the number of items in the specified container from its quota usage metadata.
+    The value is served from a cached metric, so it is cheap but may briefly lag behind writes.
+    Falls back to count_items() if the metadata is unavailable.
+    """
+    try:
+        container.read(populate_quota_info=True)
+        usage = container.client_connection.last_response_headers.get('x-ms-resource-usage', '')
+        for entry in usage.split(';'):
+            name, _, value = entry.partition('=')
+            if name == 'documentsCount':
+                return int(value)
+    except CosmosHttpResponseError as e:
+        logging.warning(f"Failed to read quota usage for container: {e}")
+    return count_items(container)
+
+def workers_for_throughput(container, request_charge=WRITE_REQUEST_CHARGE):
+    """
+    Return the number of writer threads for the container's provisioned throughput:
+    one per request_charge RU/s, between MIN_WORKERS and MAX_WORKERS.
+    Autoscale containers are sized for their maximum throughput. Falls back to
+    DEFAULT_WORKERS if the container has no dedicated throughput (shared or serverless).
+    """
+    try:
+        throughput = container.get_throughput()
+    except CosmosHttpResponseError as e:
+        logging.warning(f"Failed to read provisioned throughput for container: {e}")
+        return DEFAULT_WORKERS
+    ru_per_sec = throughput.auto_scale_max_throughput or throughput.offer_throughput
+    return max(MIN_WORKERS, min(ru_per_sec // request_charge, MAX_WORKERS))
+
+def has_items(container):
+    """
+    Return True if the specified container holds at least one item.
+    """
+    query = "SELECT TOP 1 VALUE c.id FROM c"
+    return any(True for _ in container.query_items(query=query, enable_cross_partition_query=True, max_item_count=1))
+
+def parse_partition_key_paths(properties):
+    """
+    Return the partition key paths from container properties as lists of property names.
+    """
+    return [path.lstrip('/').split('/') for path in properties['partitionKey']['paths']]
+
+def read_partition_key_paths(container):
+    """
+    Return the partition key paths of the container as lists of property names.
+    """
+    return parse_partition_key_paths(container.read())
+
+def partition_key_of(item, paths):
+    """
+    Return the partition key value of an item, or None if it has no usable value.
+    Hierarchical partition keys are returned as a list of values.
+    """
+    values = []
+    for path in paths:
+        value = item
+        for name in path:
+            if not isinstance(value, dict) or name not in value:
+                return None
+            value = value[name]
+        if not isinstance(value, (str, int, float, bool)):
+            return None
+        values.append(value)
+    return values[0] if len(values) == 1 else values
+
+def partition_key_projection(paths):
+    """
+    Return the SELECT list projecting the id and each partition key value as pk0, pk1, ...
+    """
+    columns = ['c.id']
+    for index, path in enumerate(paths):
+        columns.append('c' + ''.join(f'[{json.dumps(name)}]' for name in path) + f' AS pk{index}')
+    return ', '.join(columns)
+
+# Marks a partition key value that is absent from an item, which Cosmos DB treats
+# differently from an explicit null
+_MISSING = object()
+
+def _key_component(value):
+    if value is _MISSING:
+        return None
+    # Pair the value with its type: 1, 1.0 and True compare equal in Python but are
+    # different partition key values
+    if not isinstance(value, (str, int, float, bool, type(None))):
+        value = json.dumps(value, sort_keys=True)
+    return type(value).__name__, value
+
+def _lookup(item, path):
+    value = item
+    for name in path:
+        if not isinstance(value, dict) or name not in value:
+            return _MISSING
+        value = value[name]
+    return value
+
+def item_key(item, paths):
+    """
+    Return the (id, partition key) pair identifying an item. Ids are only unique within
+    a logical partition, so two items with the same id and different partition key
+    values are different items.
+    """
+    return item['id'], tuple(_key_component(_lookup(item, path)) for path in paths)
+
+def row_key(row, paths):
+    """
+    Return the item_key of a row selected with partition_key_projection(paths).
+    """
+    return row['id'], tuple(_key_component(row.get(f'pk{index}', _MISSING)) for index in range(len(paths)))
+
+def find_existing_keys(container, ids, paths):
+    """
+    Return the item_keys of the items in the specified container whose id is one of ids,
+    checked with a single parameterized query against the id index.
     """
-    query = "SELECT VALUE COUNT(1) FROM c"
-    items = list(container.query_items(query=query, enable_cross_partition_query=True))
-    return items[0] if items else 0
+    query = f"SELECT {partition_key_projection(paths)} FROM c WHERE ARRAY_CONTAINS(@ids, c.id)"
+    parameters = [{'name': '@ids', 'value': list(ids)}]
+    rows = container.query_items(query=query, parameters=parameters, enable_cross_partition_query=True, max_item_count=ID_PAGE_SIZE)
+    return {row_key(row, paths) for row in rows}
+
+def find_missing_items(source_container, destination_container, limit=MAX_REPORTED_MISSING_ITEMS):
+    """
+    Check that every source item exists in the destination container with the same id and
+    partition key. Source keys are streamed and checked EXISTENCE_CHECK_SIZE at a time,
+    so memory does not grow with the container size.
+    Returns a (checked, missing, missing_keys) tuple: the number of source items checked,
+    the number missing from the destination, and the item_keys of at most limit of them.
+    """
+    paths = read_partition_key_paths(destination_container)
+    query = f"SELECT {partition_key_projection(paths)} FROM c"
+    rows = source_container.query_items(query=query, enable_cross_partition_query=True, max_item_count=ID_PAGE_SIZE)
+    checked = 0
+    missing = 0
+    missing_keys = []
+    chunk = []
+
+    def check(chunk):
+        nonlocal missing
+        existing_keys = find_existing_keys(destination_container, {item_id for item_id, _ in chunk}, paths)
+        for key in chunk:
+            if key not in existing_keys:
+                missing += 1
+                if len(missing_keys) < limit:
+                    missing_keys.append(key)
+        chunk.clear()
+
+    for row in rows:
+        chunk.append(row_key(row, paths))
+        checked += 1
+        if len(chunk) >= EXISTENCE_CHECK_SIZE:
+            check(chunk)
+    if chunk:
+        check(chunk)
+    return checked, missing, missing_keys
 
 @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
 def upsert_item_with_retry(container, item):
@@ -76,28 +366,212 @@ def upsert_item_with_retry(container, item):
         logging.error(f"Failed to upsert item with id {item['id']}: {e}")
         raise
 
-from azure.cosmos.exceptions import CosmosHttpResponseError
-import logging
+def is_throttled(exception):
+    """
+    Return True if the exception is a throttled (429) Cosmos DB response.
+    """
+    return isinstance(exception, CosmosHttpResponseError) and exception.status_code == 429
 
-def migrate_data(source_container, destination_container, batch_size):
-    items = source_container.read_all_items(max_item_count=batch_size)
-    not_migrated_items = []
-    for item in items:
-        try:
-            destination_container.create_item(body=item)
-        except CosmosHttpResponseError as e:
-            if e.status_code == 409:  # Conflict
-                logging.warning(f"Item with id {item['id']} already exists in the destination container.")
-                not_migrated_items.append(item)
+_backoff = wait_exponential(multiplier=0.1, max=10)
+
+def wait_retry_after(retry_state):
+    """
+    Wait as long as the throttled response asked for in x-ms-retry-after-ms, or back off
+    exponentially if it did not say.
+    """
+    headers = retry_state.outcome.exception().headers or {}
+    retry_after_ms = headers.get('x-ms-retry-after-ms')
+    return float(retry_after_ms) / 1000 if retry_after_ms else _backoff(retry_state)
+
+@retry(retry=retry_if_exception(is_throttled), stop=stop_after_attempt(5), wait=wait_retry_after, reraise=True)
+def create_item_with_retry(container, item):
+    """
+    Create an item, retrying after the delay the service asks for while the request is
+    throttled (429).
+    Returns False if the item already exists in the container.
+    """
+    try:
+        container.create_item(body=item)
+        return True
+    except CosmosResourceExistsError:
+        return False
+
+@retry(retry=retry_if_exception(is_throttled), stop=stop_after_attempt(5), wait=wait_retry_after, reraise=True)
+def _execute_batch(container, operations, partition_key):
+    container.execute_item_batch(batch_operations=operations, partition_key=partition_key)
+
+def create_batch_with_retry(container, batch, partition_key):
+    """
+    Create items sharing a partition key in one transactional batch, retrying while the
+    batch is throttled (429).
+    A batch is atomic, so if any create fails (e.g. the item already exists) nothing was
+    written and the items are created one by one instead.
+    Returns a list of (item, migrated) tuples.
+    """
+    try:
+        _execute_batch(container, [('create', (item,)) for item in batch], partition_key)
+        return [(item, True) for item in batch]
+    except (CosmosHttpResponseError, CosmosBatchOperationError) as e:
+        logging.debug(f"Batch of {len(batch)} items failed with status {e.status_code}, creating them one by one")
+    return [(item, create_item_with_retry(container, item)) for item in batch]
+
+def migrate_data(source_container, destination_container, batch_size, max_workers=None):
+    """
+    Copy items from the source container to the destination container.
+    A reader thread streams source pages into a bounded queue that max_workers writer
+    threads drain, so writes overlap and memory stays bounded.
+    The reader checks EXISTENCE_CHECK_SIZE source ids at a time against the destination
+    and only queues the items whose (id, partition key) is missing there. If the destination starts out
+    empty, the checks are skipped and duplicates are caught by create_item's 409.
+    Items are grouped by partition key so each writer request creates up to
+    MAX_BATCH_OPERATIONS items in one transactional batch.
+    Unless max_workers is given, the pool is sized from the destination's provisioned
+    throughput by workers_for_throughput.
+    Progress is logged at most once every PROGRESS_LOG_INTERVAL seconds.
+    Returns a (migrated, not_migrated) tuple of item counts; not_migrated counts the items
+    that already existed in the destination container.
+    """
+    if max_workers is None:
+        max_workers = workers_for_throughput(destination_container)
+        logging.info(f"Writing with {max_workers} threads")
+    items = queue.Queue(maxsize=4 * max_workers)
+    results = queue.Queue()
+    stop = threading.Event()
+    not_migrated_ids = []
+    check_existing = has_items(destination_container)
+    partition_key_paths = read_partition_key_paths(destination_container)
+    # Typed partition key components -> (partition key, pending items)
+    groups = {}
+    grouped = 0
+
+    def flush(key):
+        nonlocal grouped
+        partition_key, batch = groups.pop(key)
+        items.put((partition_key, batch))
+        grouped -= len(batch)
+
+    def add(item):
+        nonlocal grouped
+        partition_key = partition_key_of(item, partition_key_paths)
+        # Typed components keep 1, 1.0 and True, which hash alike, in separate groups
+        key = None if partition_key is None else item_key(item, partition_key_paths)[1]
+        groups.setdefault(key, (partition_key, []))[1].append(item)
+        grouped += 1
+        if key is None or len(groups[key][1]) >= MAX_BATCH_OPERATIONS:
+            flush(key)
+        elif grouped >= MAX_GROUPED_ITEMS:
+            # Too many distinct partition keys to fill batches; send what we have
+            for key in list(groups):
+                flush(key)
+
+    def enqueue(chunk):
+        if check_existing:
+            existing_keys = find_existing_keys(destination_container, {item['id'] for item in chunk}, partition_key_paths)
+        for item in chunk:
+            if check_existing and item_key(item, partition_key_paths) in existing_keys:
+                results.put((item, False))
             else:
-                logging.error(f"Failed to create item with id {item['id']}: {e}")
-                raise
-        yield item
-    # Log not migrated items to a file
-    with open('not_migrated_items.txt', 'a') as log_file:
-        for item in not_migrated_items:
-            log_file.write(f"Item with id {item['id']} already exists in the destination container.\n")
-    return not_migrated_items
+                add(item)
+        chunk.clear()
+
+    def read():
+        try:
+            chunk = []
+            for item in source_container.read_all_items(max_item_count=batch_size):
+                if stop.is_set():
+                    break
+                chunk.append(item)
+                if len(chunk) >= EXISTENCE_CHECK_SIZE:
+                    enqueue(chunk)
+            if chunk and not stop.is_set():
+                enqueue(chunk)
+            for key in list(groups):
+                if stop.is_set():
+                    break
+                flush(key)
+        except Exception as e:
+            results.put(e)
+        finally:
+            for _ in range(max_workers):
+                items.put(None)
+
+    def write():
+        try:
+            while True:
+                group = items.get()
+                if group is None:
+                    break
+                if stop.is_set():
+                    continue
+                partition_key, batch = group
+                if partition_key is None or len(batch) == 1:
+                    batch_results = [(item, create_item_with_retry(destination_container, item)) for item in batch]
+                else:
+                    batch_results = create_batch_with_retry(destination_container, batch, partition_key)
+                for result in batch_results:
+                    results.put(result)
+        except Exception as e:
+            logging.error(f"Failed to write items to the destination container: {e}")
+            results.put(e)
+            # Keep draining so the reader is never blocked on a full queue
+            while items.get() is not None:
+                pass
+        finally:
+            results.put(None)
+
+    try:
+        with open_not_migrated_log() as not_migrated_log, ThreadPoolExecutor(max_workers=max_workers + 1, thread_name_prefix='cosmos-write') as executor:
+            executor.submit(read)
+            for _ in range(max_workers):
+                executor.submit(write)
+            try:
+                running = max_workers
+                # The ids also go to not_migrated_items.txt, so only log each one when debugging
+                log_each_not_migrated = logging.getLogger().isEnabledFor(logging.DEBUG)
+                done = 0
+                not_migrated = 0
+                next_log = time.monotonic() + PROGRESS_LOG_INTERVAL
+                while running:
+                    result = results.get()
+                    if result is None:
+                        running -= 1
+                        continue
+                    if isinstance(result, Exception):
+                        raise result
+                    item, migrated = result
+                    if not migrated:
+                        if log_each_not_migrated:
+                            logging.debug(f"Item with id {item['id']} already exists in the destination container.")
+                        not_migrated += 1
+                        not_migrated_ids.append(item['id'])
+                        if len(not_migrated_ids) >= NOT_MIGRATED_FLUSH_SIZE:
+                            log_not_migrated_items(not_migrated_log, not_migrated_ids)
+                    done += 1
+                    if time.monotonic() >= next_log:
+                        logging.info(f"Processed {done} items")
+                        next_log = time.monotonic() + PROGRESS_LOG_INTERVAL
+                return done - not_migrated, not_migrated
+            finally:
+                stop.set()
+                log_not_migrated_items(not_migrated_log, not_migrated_ids)
+    finally:
+        # Exiting the executor waited for the writers, so the destination count has changed
+        forget_count(destination_container)
+
+def open_not_migrated_log():
+    """
+    Open not_migrated_items.txt for appending with a large write buffer.
+    """
+    return open('not_migrated_items.txt', 'a', buffering=1 << 20)
+
+def log_not_migrated_items(log_file, item_ids):
+    """
+    Write the buffered ids of items that already existed in the destination container
+    to the log file in a single call, then clear the buffer.
+    """
+    if item_ids:
+        log_file.write(''.join(f"Item with id {item_id} already exists in the destination container.\n" for item_id in item_ids))
+        item_ids.clear()
 
 def verify_data(source_container, destination_container):
     """
@@ -108,17 +582,18 @@ def verify_data(source_container, destination_container):
     if source_count == destination_count:
         validation_result = "Data verification successful. Source and destination containers have the same number of items."
         logging.info(validation_result)
-        print(validation_result)
     else:
         validation_result = f"Data verification failed. Source has {source_count} items, but destination has {destination_count} items."
         logging.error(validation_result)
-        print(validation_result)
     return validation_result
 
 def main():
     """
     Main function to handle the migration process.
     """
+    configure_logging(logging.INFO)
+    fast_json.install()
+
     parser = argparse.ArgumentParser(description='Migrate data from one Cosmos DB container to another.')
     parser.add_argument('--batch-size', type=int, default=100, help='Number of items to process in each batch.')
     args = parser.parse_args()
@@ -136,15 +611,13 @@ def main():
     # Count items in source container
     source_count = count_items(source_container)
     logging.info(f"Number of items in source container: {source_count}")
-    print(f"Number of items in source container: {source_count}")
 
     # Migrate data
     start_time = time.time()
-    migrate_data(source_container, destination_container, batch_size)
+    migrated, not_migrated = migrate_data(source_container, destination_container, batch_size)
     end_time = time.time()
     duration = end_time - start_time
-    logging.info(f"Data migration took {duration:.2f} seconds.")
-    print(f"Data migration took {duration:.2f} seconds.")
+    logging.info(f"Data migration took {duration:.2f} seconds. {migrated} items migrated, {not_migrated} already existed.")
 
     # Verify data
     verify_data(source_container, destination_container)
@@ -0,0 +1,305 @@
+import asyncio
+import logging
+import time
+import aiohttp
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.cosmos.aio import CosmosClient
+from azure.cosmos.exceptions import CosmosResourceExistsError, CosmosHttpResponseError, CosmosBatchOperationError
+from cosmos_data_migration import (
+    ID_PAGE_SIZE, EXISTENCE_CHECK_SIZE, NOT_MIGRATED_FLUSH_SIZE, get_connection_policy, open_not_migrated_log, log_not_migrated_items, forget_count,
+    MAX_BATCH_OPERATIONS, MAX_GROUPED_ITEMS, parse_partition_key_paths, partition_key_projection, partition_key_of, item_key, row_key
+)
+
+# Default number of insert workers, i.e. the maximum number of create_item requests in flight
+MAX_CONCURRENCY = 256
+
+# Number of attempts for a throttled (429) create_item before giving up
+MAX_RETRIES = 5
+
+# Maximum number of writes in flight for one partition key value; more would only
+# queue up on the same partition while the others sit idle
+MAX_IN_FLIGHT_PER_PARTITION_KEY = 4
+
+# Bounds for the number of items written between throughput adjustments
+MIN_BATCH_SIZE = 1
+MAX_BATCH_SIZE = 2000
+
+class ThroughputController:
+    """
+    Feedback loop that keeps the request charge of the copy near target_ru_per_sec.
+    After every batch the observed RU/s is compared with the target: the batch size is
+    scaled by target / observed, the producer pauses long enough to bring the batch back
+    under the budget, and an extra backoff doubles while requests are throttled (429)
+    and halves once they are not.
+    """
+    def __init__(self, target_ru_per_sec, batch_size):
+        self.target_ru_per_sec = target_ru_per_sec
+        self.batch_size = max(MIN_BATCH_SIZE, min(batch_size, MAX_BATCH_SIZE))
+        self.backoff = 0.0
+        self.request_charge = 0.0
+        self.throttled = False
+        self.window_start = time.monotonic()
+
+    def record_charge(self, headers, result):
+        """
+        Response hook accumulating the request charge of each write. The SDK retries 429s
+        itself before a write succeeds or raises, and reports how often it did in
+        x-ms-throttle-retry-count, so any retries there mark the batch as throttled.
+        """
+        self.request_charge += float(headers.get('x-ms-request-charge', 0))
+        if int(headers.get('x-ms-throttle-retry-count', 0)):
+            self.throttled = True
+
+    async def next_batch(self):
+        """
+        Adjust the batch size from the last batch's RU/s and sleep before the next batch.
+        """
+        elapsed = time.monotonic() - self.window_start
+        observed_ru_per_sec = self.request_charge / elapsed if elapsed else 0.0
+        factor = self.target_ru_per_sec / max(observed_ru_per_sec, 1)
+        self.batch_size = int(max(MIN_BATCH_SIZE, min(self.batch_size * factor, MAX_BATCH_SIZE)))
+        if self.throttled:
+            self.backoff = max(self.backoff * 2, 0.1)
+        else:
+            self.backoff /= 2
+        delay = max(0.0, self.request_charge / self.target_ru_per_sec - elapsed) + self.backoff
+        logging.debug(f"Observed {observed_ru_per_sec:.0f} RU/s, next batch of {self.batch_size} items after {delay:.2f}s")
+        self.request_charge = 0.0
+        self.throttled = False
+        await asyncio.sleep(delay)
+        self.window_start = time.monotonic()
+
+def get_aio_client(config, max_connections=MAX_CONCURRENCY):
+    """
+    Create and return an asynchronous CosmosClient instance using the provided configuration.
+    The HTTP session allows max_connections concurrent connections instead of aiohttp's
+    default of 100, so every insert worker can have a request in flight. Like the session
+    azure-core would create, it reads proxy settings (HTTPS_PROXY, NO_PROXY) from the environment.
+    Must be called from within a running event loop.
+    """
+    session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=max_connections),
+        cookie_jar=aiohttp.DummyCookieJar(),
+        auto_decompress=False,
+        trust_env=True
+    )
+    transport = AioHttpTransport(session=session, session_owner=True)
+    return CosmosClient(config['endpoint'], config['key'], connection_policy=get_connection_policy(), transport=transport)
+
+def get_aio_container(client, database_name, container_name):
+    """
+    Get a container from the specified database using an asynchronous client.
+    """
+    database = client.get_database_client(database_name)
+    return database.get_container_client(container_name)
+
+async def has_items(container):
+    """
+    Return True if the specified container holds at least one item.
+    """
+    query = "SELECT TOP 1 VALUE c.id FROM c"
+    async for _ in container.query_items(query=query, max_item_count=1):
+        return True
+    return False
+
+async def find_existing_keys(container, ids, paths):
+    """
+    Return the item_keys of the items in the specified container whose id is one of ids,
+    checked with a single parameterized query against the id index.
+    """
+    query = f"SELECT {partition_key_projection(paths)} FROM c WHERE ARRAY_CONTAINS(@ids, c.id)"
+    parameters = [{'name': '@ids', 'value': list(ids)}]
+    return {row_key(row, paths) async for row in container.query_items(query=query, parameters=parameters, max_item_count=ID_PAGE_SIZE)}
+
+async def create_item_with_retry(container, item, controller=None):
+    """
+    Create an item, backing off exponentially while the request is throttled (429).
+    Request charges and throttling are reported to the controller, if given.
+    Returns False if the item already exists in the container.
+    """
+    kwargs = {'response_hook': controller.record_charge} if controller else {}
+    for attempt in range(MAX_RETRIES):
+        try:
+            await container.create_item(body=item, **kwargs)
+            return True
+        except CosmosResourceExistsError:
+            return False
+        except CosmosHttpResponseError as e:
+            if e.status_code != 429 or attempt == MAX_RETRIES - 1:
+                logging.error(f"Failed to create item with id {item['id']}: {e}")
+                raise
+            if controller:
+                controller.throttled = True
+            await asyncio.sleep(0.1 * 2 ** attempt)
+
+async def create_batch_with_retry(container, batch, partition_key, controller=None):
+    """
+    Create items sharing a partition key in one transactional batch, backing off
+    exponentially while the batch is throttled (429).
+    A batch is atomic, so if any create fails (e.g. the item already exists) nothing was
+    written and the items are created one by one instead.
+    Returns a list of (item, migrated) tuples.
+    """
+    kwargs = {'response_hook': controller.record_charge} if controller else {}
+    operations = [('create', (item,)) for item in batch]
+    for attempt in range(MAX_RETRIES):
+        try:
+            await container.execute_item_batch(batch_operations=operations, partition_key=partition_key, **kwargs)
+            return [(item, True) for item in batch]
+        except (CosmosHttpResponseError, CosmosBatchOperationError) as e:
+            if e.status_code != 429 or attempt == MAX_RETRIES - 1:
+                logging.debug(f"Batch of {len(batch)} items failed with status {e.status_code}, creating them one by one")
+                break
+            if controller:
+                controller.throttled = True
+            await asyncio.sleep(0.1 * 2 ** attempt)
+    return [(item, await create_item_with_retry(container, item, controller)) for item in batch]
+
+async def read_partition_key_paths(container):
+    """
+    Return the partition key paths of the container as lists of property names.
+    """
+    return parse_partition_key_paths(await container.read())
+
+async def migrate_data(source_container, destination_container, batch_size, target_ru_per_sec=None, max_concurrency=MAX_CONCURRENCY):
+    """
+    Copy items from the source container to the destination container.
+    Source pages are streamed into a bounded queue drained by max_concurrency insert
+    workers, so writes start with the first page and memory does not grow with the
+    container size. Source items are checked EXISTENCE_CHECK_SIZE at a time against the
+    destination so only items whose (id, partition key) is missing there are written; if the destination starts out empty
+    the checks are skipped and duplicates are caught by create_item's 409. Items are
+    grouped by partition key so each worker request creates up to MAX_BATCH_OPERATIONS
+    items in one transactional batch. If target_ru_per_sec is given, a
+    ThroughputController paces the producer so the writes converge on that budget.
+    At most MAX_IN_FLIGHT_PER_PARTITION_KEY writes per partition key are in flight, so
+    the workers spread over partitions instead of piling onto one.
+    Yields an (item, migrated) tuple per source item as its write completes; migrated is
+    False when the item already existed in the destination container.
+    """
+    partition_key_paths = await read_partition_key_paths(destination_container)
+    check_existing = await has_items(destination_container)
+    # Buffer a few items per worker between the pipeline stages
+    items = asyncio.Queue(maxsize=4 * max_concurrency)
+    results = asyncio.Queue(maxsize=4 * max_concurrency)
+    not_migrated_ids = []
+    controller = ThroughputController(target_ru_per_sec, batch_size) if target_ru_per_sec else None
+    # Typed partition key components -> number of writes in flight for it
+    in_flight = {}
+    slot_freed = asyncio.Condition()
+
+    async def produce():
+        # Typed partition key components -> (partition key, pending items)
+        groups = {}
+        grouped = 0
+        queued = 0
+
+        async def flush(key):
+            nonlocal grouped, queued
+            partition_key, batch = groups.pop(key)
+            await items.put((key, partition_key, batch))
+            grouped -= len(batch)
+            queued += len(batch)
+            if controller and queued >= controller.batch_size:
+                await controller.next_batch()
+                queued = 0
+
+        async def add(item):
+            nonlocal grouped
+            partition_key = partition_key_of(item, partition_key_paths)
+            # Typed components keep 1, 1.0 and True, which hash alike, in separate groups
+            key = None if partition_key is None else item_key(item, partition_key_paths)[1]
+            groups.setdefault(key, (partition_key, []))[1].append(item)
+            grouped += 1
+            if key is None or len(groups[key][1]) >= MAX_BATCH_OPERATIONS:
+                await flush(key)
+            elif grouped >= MAX_GROUPED_ITEMS:
+                # Too many distinct partition keys to fill batches; send what we have
+                for key in list(groups):
+                    await flush(key)
+
+        async def enqueue(chunk):
+            if check_existing:
+                existing_keys = await find_existing_keys(destination_container, {item['id'] for item in chunk}, partition_key_paths)
+            for item in chunk:
+                if check_existing and item_key(item, partition_key_paths) in existing_keys:
+                    await results.put((item, False))
+                else:
+                    await add(item)
+            chunk.clear()
+
+        try:
+            chunk = []
+            async for item in source_container.read_all_items(max_item_count=batch_size):
+                chunk.append(item)
+                if len(chunk) >= EXISTENCE_CHECK_SIZE:
+                    await enqueue(chunk)
+            if chunk:
+                await enqueue(chunk)
+            for key in list(groups):
+                await flush(key)
+        except Exception as e:
+            await results.put(e)
+        finally:
+            for _ in range(max_concurrency):
+                await items.put(None)
+
+    async def consume():
+        try:
+            while True:
+                group = await items.get()
+                if group is None:
+                    break
+                key, partition_key, batch = group
+                if key is None:
+                    batch_results = [(item, await create_item_with_retry(destination_container, item, controller)) for item in batch]
+                else:
+                    async with slot_freed:
+                        await slot_freed.wait_for(lambda: in_flight.get(key, 0) < MAX_IN_FLIGHT_PER_PARTITION_KEY)
+                        in_flight[key] = in_flight.get(key, 0) + 1
+                    try:
+                        if len(batch) == 1:
+                            batch_results = [(batch[0], await create_item_with_retry(destination_container, batch[0], controller))]
+                        else:
+                            batch_results = await create_batch_with_retry(destination_container, batch, partition_key, controller)
+                    finally:
+                        async with slot_freed:
+                            in_flight[key] -= 1
+                            if not in_flight[key]:
+                                del in_flight[key]
+                            slot_freed.notify_all()
+                for result in batch_results:
+                    await results.put(result)
+        except Exception as e:
+            await results.put(e)
+        finally:
+            await results.put(None)
+
+    tasks = [asyncio.create_task(produce())]
+    tasks.extend(asyncio.create_task(consume()) for _ in range(max_concurrency))
+    with open_not_migrated_log() as not_migrated_log:
+        try:
+            running = max_concurrency
+            # The ids also go to not_migrated_items.txt, so only log each one when debugging
+            log_each_not_migrated = logging.getLogger().isEnabledFor(logging.DEBUG)
+            while running:
+                result = await results.get()
+                if result is None:
+                    running -= 1
+                    continue
+                if isinstance(result, Exception):
+                    raise result
+                item, migrated = result
+                if not migrated:
+                    if log_each_not_migrated:
+                        logging.debug(f"Item with id {item['id']} already exists in the destination container.")
+                    not_migrated_ids.append(item['id'])
+                    if len(not_migrated_ids) >= NOT_MIGRATED_FLUSH_SIZE:
+                        log_not_migrated_items(not_migrated_log, not_migrated_ids)
+                yield item, migrated
+        finally:
+            for task in tasks:
+                task.cancel()
+            log_not_migrated_items(not_migrated_log, not_migrated_ids)
+            # The container link matches the synchronous client's, so cached counts are shared
+            forget_count(destination_container)
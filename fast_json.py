@@ -0,0 +1,44 @@
+import json
+import types
+import azure.cosmos._synchronized_request
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Compact separators the Cosmos SDK uses for request bodies, the only output orjson produces
+COMPACT_SEPARATORS = (',', ':')
+
+def dumps(obj, separators=None, ensure_ascii=True, **kwargs):
+    """
+    json.dumps replacement that serializes compact JSON with orjson.
+    Falls back to json.dumps for other options, for values orjson cannot serialize, and
+    for non-ASCII output when ensure_ascii is set, so the result is the JSON json.dumps
+    would send, though floats may use a shorter exponent form (1e16 for 1e+16).
+    orjson writes NaN and Infinity as null where json.dumps writes tokens Cosmos DB
+    rejects; documents read from Cosmos DB cannot hold them, so this is not checked.
+    """
+    if kwargs or separators != COMPACT_SEPARATORS:
+        return json.dumps(obj, separators=separators, ensure_ascii=ensure_ascii, **kwargs)
+    try:
+        dumped = orjson.dumps(obj).decode()
+    except orjson.JSONEncodeError:
+        return json.dumps(obj, separators=separators, ensure_ascii=ensure_ascii)
+    if ensure_ascii and not dumped.isascii():
+        return json.dumps(obj, separators=separators)
+    return dumped
+
+def install():
+    """
+    Make the Cosmos SDK serialize request bodies with orjson; the synchronous and
+    asynchronous clients share the same serializer. Responses are still parsed
+    by json.loads, since orjson reads integers beyond 64 bits as floats.
+    Does nothing if orjson is not installed. Returns True if orjson is in use.
+    """
+    if orjson is None:
+        return False
+    fast = types.SimpleNamespace(**vars(json))
+    fast.dumps = dumps
+    azure.cosmos._synchronized_request.json = fast
+    return True
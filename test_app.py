@@ -1,8 +1,306 @@
+# app is imported first so gevent patches the standard library before anything else loads it
+from app import app, migrate, validate_data, migration_status, migration_lock
+import asyncio
+import atexit
+import itertools
+import json
+import threading
+import time
 import unittest
 from unittest.mock import patch, MagicMock
 from flask import Flask
 from flask_socketio import SocketIO
-from app import app, migrate, validate_data, migration_status
+from azure.cosmos.exceptions import CosmosResourceExistsError, CosmosResourceNotFoundError, CosmosHttpResponseError, CosmosBatchOperationError
+import cosmos_data_migration
+import cosmos_data_migration_async
+import fast_json
+
+def setUpModule():
+    # The log listener's console handler keeps the stderr it was created with, which
+    # pytest's output capture closes; stop it so test logs stay queued instead
+    listener = cosmos_data_migration._log_listener
+    if listener is not None:
+        listener.stop()
+        atexit.unregister(listener.stop)
+        for handler in listener.handlers:
+            handler.close()
+
+def async_results(results):
+    """
+    Build a stand-in for an async generator function that yields the given results.
+    """
+    async def generate(*args, **kwargs):
+        for result in results:
+            yield result
+    return generate
+
+class FakeContainer:
+    """
+    In-memory stand-in for a synchronous container partitioned on /pk. Ids are unique per
+    partition key value, as in Cosmos DB. Only the queries issued by the migration are understood.
+    Transactional batches are recorded as (partition key, ids) and fail with batch_error if it is set.
+    """
+    links = itertools.count()
+
+    def __init__(self, items=()):
+        self.items = {self.key(item): item for item in items}
+        self.created = []
+        self.batches = []
+        self.batch_error = None
+        # Unique per fake, so cached counts never carry over between tests
+        self.container_link = f'dbs/test/colls/{next(self.links)}'
+
+    @staticmethod
+    def key(item):
+        return item['id'], type(item.get('pk')).__name__, item.get('pk')
+
+    def read(self, **kwargs):
+        return {'partitionKey': {'paths': ['/pk']}}
+
+    def read_all_items(self, **kwargs):
+        return list(self.items.values())
+
+    def query_items(self, query, parameters=None, **kwargs):
+        items = list(self.items.values())
+        if parameters:
+            ids = set(parameters[0]['value'])
+            items = [item for item in items if item['id'] in ids]
+        if query.startswith('SELECT VALUE COUNT(1)'):
+            return [len(items)]
+        if query.startswith('SELECT TOP 1'):
+            return [item['id'] for item in items[:1]]
+        if query.startswith('SELECT VALUE c.id'):
+            return [item['id'] for item in items]
+        return [{'id': item['id'], **({'pk0': item['pk']} if 'pk' in item else {})} for item in items]
+
+    def create_item(self, body, **kwargs):
+        if self.key(body) in self.items:
+            raise CosmosResourceExistsError(message='Conflict')
+        self.items[self.key(body)] = body
+        self.created.append(body['id'])
+
+    def execute_item_batch(self, batch_operations, partition_key, **kwargs):
+        bodies = [args[0] for _, args in batch_operations]
+        self.batches.append((partition_key, [body['id'] for body in bodies]))
+        if self.batch_error:
+            raise self.batch_error
+        for index, body in enumerate(bodies):
+            if self.key(body) in self.items:
+                raise CosmosBatchOperationError(error_index=index, headers={}, status_code=409, message='Conflict')
+        for body in bodies:
+            FakeContainer.create_item(self, body)
+
+class AsyncFakeContainer(FakeContainer):
+    """
+    Asynchronous version of FakeContainer. The most batches ever in flight at once for
+    each partition key is kept in peak_in_flight.
+    """
+    def __init__(self, items=()):
+        super().__init__(items)
+        self.in_flight = {}
+        self.peak_in_flight = {}
+
+    async def read(self, **kwargs):
+        return FakeContainer.read(self)
+
+    def read_all_items(self, **kwargs):
+        return self.iterate(FakeContainer.read_all_items(self))
+
+    def query_items(self, query, parameters=None, **kwargs):
+        return self.iterate(FakeContainer.query_items(self, query, parameters))
+
+    async def iterate(self, results):
+        for result in results:
+            yield result
+
+    async def create_item(self, body, **kwargs):
+        await asyncio.sleep(0)
+        FakeContainer.create_item(self, body)
+
+    async def execute_item_batch(self, batch_operations, partition_key, **kwargs):
+        self.in_flight[partition_key] = self.in_flight.get(partition_key, 0) + 1
+        self.peak_in_flight[partition_key] = max(self.peak_in_flight.get(partition_key, 0), self.in_flight[partition_key])
+        try:
+            # Stay in flight for a few scheduler rounds so concurrent batches overlap
+            for _ in range(3):
+                await asyncio.sleep(0)
+            FakeContainer.execute_item_batch(self, batch_operations, partition_key)
+        finally:
+            self.in_flight[partition_key] -= 1
+
+async def collect(results):
+    return [result async for result in results]
+
+class TestMigrateData(unittest.TestCase):
+
+    def setUp(self):
+        # Keep the migrations from appending skipped ids to not_migrated_items.txt
+        patch('cosmos_data_migration.open_not_migrated_log', MagicMock()).start()
+        patch('cosmos_data_migration_async.open_not_migrated_log', MagicMock()).start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_existing_id_in_another_partition_is_migrated(self):
+        # Ids are only unique per partition key, so 'a' in p1 does not hide 'a' in p2
+        source = FakeContainer([{'id': 'a', 'pk': 'p2'}, {'id': 'b', 'pk': 'p1'}])
+        destination = FakeContainer([{'id': 'a', 'pk': 'p1'}, {'id': 'b', 'pk': 'p1'}])
+
+        migrated, not_migrated = cosmos_data_migration.migrate_data(source, destination, 10, max_workers=2)
+
+        self.assertEqual((migrated, not_migrated), (1, 1))
+        self.assertEqual(destination.created, ['a'])
+        self.assertIn(('a', 'str', 'p2'), destination.items)
+
+    def test_existing_items_are_skipped(self):
+        source = FakeContainer([{'id': str(n), 'pk': 'p1'} for n in range(50)])
+        destination = FakeContainer([{'id': str(n), 'pk': 'p1'} for n in range(0, 50, 5)])
+
+        migrated, not_migrated = cosmos_data_migration.migrate_data(source, destination, 10, max_workers=4)
+
+        self.assertEqual((migrated, not_migrated), (40, 10))
+        self.assertEqual(sorted(destination.created, key=int), [str(n) for n in range(50) if n % 5])
+
+    def test_not_migrated_ids_are_logged(self):
+        source = FakeContainer([{'id': 'a', 'pk': 'p1'}, {'id': 'b', 'pk': 'p1'}])
+        destination = FakeContainer([{'id': 'b', 'pk': 'p1'}])
+
+        cosmos_data_migration.migrate_data(source, destination, 10, max_workers=2)
+
+        log_file = cosmos_data_migration.open_not_migrated_log.return_value.__enter__.return_value
+        log_file.write.assert_called_once_with("Item with id b already exists in the destination container.\n")
+
+    @patch('cosmos_data_migration.verify_data')
+    @patch('cosmos_data_migration.configure_logging')
+    @patch('cosmos_data_migration.get_container')
+    @patch('cosmos_data_migration.get_cosmos_client')
+    def test_main_migrates(self, mock_get_cosmos_client, mock_get_container, mock_configure_logging, mock_verify_data):
+        source = FakeContainer([{'id': 'a', 'pk': 'p1'}, {'id': 'b', 'pk': 'p1'}])
+        destination = FakeContainer()
+        mock_get_container.side_effect = [source, destination]
+
+        with patch('sys.argv', ['cosmos_data_migration.py', '--batch-size', '10']), \
+                patch('cosmos_data_migration.workers_for_throughput', return_value=2):
+            cosmos_data_migration.main()
+
+        self.assertEqual(sorted(destination.created), ['a', 'b'])
+        mock_verify_data.assert_called_once_with(source, destination)
+
+    def test_writer_error_aborts_migration(self):
+        source = FakeContainer([{'id': str(n), 'pk': 'p1'} for n in range(50)])
+        destination = FakeContainer()
+        destination.batch_error = CosmosHttpResponseError(status_code=500, message='Internal error')
+        destination.create_item = MagicMock(side_effect=destination.batch_error)
+
+        with self.assertRaises(CosmosHttpResponseError):
+            cosmos_data_migration.migrate_data(source, destination, 10, max_workers=4)
+        # Failed writes are not retried, and every writer stops after its first failure
+        self.assertLessEqual(destination.create_item.call_count, 4)
+
+    def test_items_are_batched_by_partition_key(self):
+        # 1, True and 1.0 hash alike in Python but are three partition key values in Cosmos DB
+        source = FakeContainer([{'id': f'{prefix}{n}', 'pk': pk} for prefix, pk in (('i', 1), ('b', True), ('f', 1.0)) for n in (1, 2)])
+        destination = FakeContainer()
+
+        migrated, not_migrated = cosmos_data_migration.migrate_data(source, destination, 10, max_workers=2)
+
+        self.assertEqual((migrated, not_migrated), (6, 0))
+        self.assertEqual(
+            sorted((type(partition_key).__name__, ids) for partition_key, ids in destination.batches),
+            [('bool', ['b1', 'b2']), ('float', ['f1', 'f2']), ('int', ['i1', 'i2'])]
+        )
+
+    @patch('cosmos_data_migration.has_items')
+    def test_conflicting_batch_falls_back_to_single_creates(self, mock_has_items):
+        # 'b' appears in the destination after the existence checks were skipped
+        mock_has_items.return_value = False
+        source = FakeContainer([{'id': 'a', 'pk': 'p1'}, {'id': 'b', 'pk': 'p1'}])
+        destination = FakeContainer([{'id': 'b', 'pk': 'p1'}])
+
+        migrated, not_migrated = cosmos_data_migration.migrate_data(source, destination, 10, max_workers=2)
+
+        self.assertEqual((migrated, not_migrated), (1, 1))
+        self.assertEqual(destination.batches, [('p1', ['a', 'b'])])
+        self.assertEqual(destination.created, ['a'])
+
+    def test_existing_id_in_another_partition_is_migrated_async(self):
+        source = AsyncFakeContainer([{'id': 'a', 'pk': 'p2'}, {'id': 'b', 'pk': 'p1'}])
+        destination = AsyncFakeContainer([{'id': 'a', 'pk': 'p1'}, {'id': 'b', 'pk': 'p1'}])
+
+        results = asyncio.run(collect(cosmos_data_migration_async.migrate_data(source, destination, 10, max_concurrency=2)))
+
+        self.assertEqual(sorted((item['id'], item['pk'], migrated) for item, migrated in results), [('a', 'p2', True), ('b', 'p1', False)])
+        self.assertEqual(destination.created, ['a'])
+
+    def test_batches_group_equal_partition_keys_of_different_types(self):
+        # 1, True and 1.0 hash alike in Python but are three partition key values in Cosmos DB
+        source = AsyncFakeContainer([{'id': f'{prefix}{n}', 'pk': pk} for prefix, pk in (('i', 1), ('b', True), ('f', 1.0)) for n in (1, 2)])
+        destination = AsyncFakeContainer()
+
+        asyncio.run(collect(cosmos_data_migration_async.migrate_data(source, destination, 10, max_concurrency=2)))
+
+        self.assertEqual(
+            sorted((type(partition_key).__name__, ids) for partition_key, ids in destination.batches),
+            [('bool', ['b1', 'b2']), ('float', ['f1', 'f2']), ('int', ['i1', 'i2'])]
+        )
+
+    def test_writes_per_partition_key_are_capped(self):
+        # A hot partition key with ten full batches, and items for other keys behind it
+        source = AsyncFakeContainer(
+            [{'id': str(n), 'pk': 'hot'} for n in range(1000)] + [{'id': str(n), 'pk': f'p{n % 4}'} for n in range(800)]
+        )
+        destination = AsyncFakeContainer()
+
+        results = asyncio.run(collect(cosmos_data_migration_async.migrate_data(source, destination, 100, max_concurrency=16)))
+
+        self.assertEqual(len(results), 1800)
+        self.assertEqual(destination.peak_in_flight['hot'], cosmos_data_migration_async.MAX_IN_FLIGHT_PER_PARTITION_KEY)
+        self.assertTrue(all(peak <= cosmos_data_migration_async.MAX_IN_FLIGHT_PER_PARTITION_KEY for peak in destination.peak_in_flight.values()))
+
+    @patch('cosmos_data_migration_async.has_items')
+    def test_conflicting_batch_falls_back_to_single_creates_async(self, mock_has_items):
+        # 'b' appears in the destination after the existence checks were skipped
+        mock_has_items.return_value = False
+        source = AsyncFakeContainer([{'id': 'a', 'pk': 'p1'}, {'id': 'b', 'pk': 'p1'}])
+        destination = AsyncFakeContainer([{'id': 'b', 'pk': 'p1'}])
+
+        results = asyncio.run(collect(cosmos_data_migration_async.migrate_data(source, destination, 10, max_concurrency=2)))
+
+        self.assertEqual(sorted((item['id'], migrated) for item, migrated in results), [('a', True), ('b', False)])
+        self.assertEqual(destination.batches, [('p1', ['a', 'b'])])
+        self.assertEqual(destination.created, ['a'])
+
+    def test_failed_batch_falls_back_to_single_creates(self):
+        source = AsyncFakeContainer([{'id': 'a', 'pk': 'p1'}, {'id': 'b', 'pk': 'p1'}])
+        destination = AsyncFakeContainer()
+        destination.batch_error = CosmosHttpResponseError(status_code=413, message='Request entity too large')
+
+        results = asyncio.run(collect(cosmos_data_migration_async.migrate_data(source, destination, 10, max_concurrency=2)))
+
+        self.assertEqual(sorted((item['id'], migrated) for item, migrated in results), [('a', True), ('b', True)])
+        self.assertEqual(len(destination.batches), 1)
+        self.assertEqual(destination.created, ['a', 'b'])
+
+    def test_destination_count_is_not_cached_across_migration(self):
+        source = FakeContainer([{'id': 'a', 'pk': 'p1'}, {'id': 'b', 'pk': 'p1'}])
+        destination = FakeContainer([{'id': 'b', 'pk': 'p1'}])
+        self.assertEqual(cosmos_data_migration.count_items(destination), 1)
+
+        cosmos_data_migration.migrate_data(source, destination, 10, max_workers=2)
+
+        self.assertEqual(cosmos_data_migration.count_items(destination), 2)
+
+    def test_destination_count_is_not_cached_across_migration_async(self):
+        source = AsyncFakeContainer([{'id': 'a', 'pk': 'p1'}, {'id': 'b', 'pk': 'p1'}])
+        destination = AsyncFakeContainer([{'id': 'b', 'pk': 'p1'}])
+        # Counts are taken with the synchronous client, which shares the container link
+        counted = FakeContainer()
+        counted.items, counted.container_link = destination.items, destination.container_link
+        self.assertEqual(cosmos_data_migration.count_items(counted), 1)
+
+        asyncio.run(collect(cosmos_data_migration_async.migrate_data(source, destination, 10, max_concurrency=2)))
+
+        self.assertEqual(cosmos_data_migration.count_items(counted), 2)
 
 class TestApp(unittest.TestCase):
 
@@ -10,16 +308,37 @@ class TestApp(unittest.TestCase):
         self.app = app.test_client()
         self.app.testing = True
 
+    def form_data(self, **fields):
+        """
+        Return a valid migration form, with the given fields overridden.
+        """
+        data = {
+            'source_endpoint': 'source_endpoint',
+            'source_key': 'source_key',
+            'source_database_name': 'source_database_name',
+            'source_container_name': 'source_container_name',
+            'destination_endpoint': 'destination_endpoint',
+            'destination_key': 'destination_key',
+            'destination_database_name': 'destination_database_name',
+            'destination_container_name': 'destination_container_name',
+            'batch_size': '5'
+        }
+        data.update(fields)
+        return data
+
+    @patch('app.get_aio_container')
+    @patch('app.get_aio_client')
     @patch('app.get_cosmos_client')
     @patch('app.get_container')
-    @patch('app.count_items')
-    @patch('app.migrate_data')
-    def test_migrate(self, mock_migrate_data, mock_count_items, mock_get_container, mock_get_cosmos_client):
+    @patch('app.fast_count')
+    @patch('app.migrate_data_async')
+    def test_migrate(self, mock_migrate_data, mock_count_items, mock_get_container, mock_get_cosmos_client, mock_get_aio_client, mock_get_aio_container):
         # Mock the return values
         mock_get_cosmos_client.return_value = MagicMock()
+        mock_get_aio_client.return_value = MagicMock()
         mock_get_container.return_value = MagicMock()
         mock_count_items.return_value = 10
-        mock_migrate_data.return_value = range(10)
+        mock_migrate_data.side_effect = async_results([({'id': str(i)}, True) for i in range(10)])
 
         source_config = {
             'endpoint': 'source_endpoint',
@@ -37,26 +356,143 @@ class TestApp(unittest.TestCase):
 
         with patch('app.socketio.emit') as mock_emit:
             migrate(source_config, destination_config, batch_size)
-            self.assertEqual(migration_status['source_count'], 10)
-            self.assertIn('Data migration completed successfully', migration_status['progress'])
+            self.assertEqual(migration_status.source_count, 10)
+            self.assertIn('Data migration completed successfully', migration_status.progress)
             mock_emit.assert_called()
 
+    @patch('app.get_aio_container')
+    @patch('app.get_aio_client')
     @patch('app.get_cosmos_client')
     @patch('app.get_container')
-    @patch('app.count_items')
-    def test_validate_data(self, mock_count_items, mock_get_container, mock_get_cosmos_client):
-        # Mock the return values
-        mock_get_cosmos_client.return_value = MagicMock()
-        mock_get_container.return_value = MagicMock()
-        mock_count_items.side_effect = [10, 10]
+    @patch('app.fast_count')
+    @patch('app.migrate_data_async')
+    def test_migrate_throttles_progress_emits(self, mock_migrate_data, mock_count_items, mock_get_container, mock_get_cosmos_client, mock_get_aio_client, mock_get_aio_container):
+        mock_count_items.return_value = 10000
+        mock_migrate_data.side_effect = async_results([({'id': str(i)}, True) for i in range(10000)])
+        config = {'endpoint': 'endpoint', 'key': 'key', 'database_name': 'database_name', 'container_name': 'container_name'}
+
+        # With the clock frozen, only every 1% of the items triggers an emit
+        with patch('app.time') as mock_time, patch('app.socketio.emit') as mock_emit, patch('app.socketio.start_background_task'):
+            mock_time.monotonic.return_value = 1000.0
+            migrate(config, config, 5)
+
+        progress_emits = [args for args, _ in mock_emit.call_args_list if 'progress_percentage' in args[1]]
+        # One emit per 100 items, then the final one
+        self.assertEqual(len(progress_emits), 101)
+        self.assertEqual(progress_emits[-1][1], {'progress': migration_status.progress, 'progress_percentage': 100})
+        self.assertIn('10000 items migrated', migration_status.progress)
 
+    @patch('app.get_aio_container')
+    @patch('app.get_aio_client')
+    @patch('app.get_cosmos_client')
+    @patch('app.get_container')
+    @patch('app.fast_count')
+    @patch('app.migrate_data_async')
+    def test_migrate_starts_validation(self, mock_migrate_data, mock_count_items, mock_get_container, mock_get_cosmos_client, mock_get_aio_client, mock_get_aio_container):
         source_container = MagicMock()
         destination_container = MagicMock()
+        mock_get_container.side_effect = [source_container, destination_container]
+        mock_count_items.return_value = 2
+        mock_migrate_data.side_effect = async_results([({'id': '1'}, True), ({'id': '2'}, False)])
+
+        config = {'endpoint': 'endpoint', 'key': 'key', 'database_name': 'database_name', 'container_name': 'container_name'}
+
+        with patch('app.socketio.emit'), patch('app.socketio.start_background_task') as mock_start_background_task:
+            migrate(config, config, 5)
+            mock_start_background_task.assert_called_once_with(validate_data, source_container, destination_container, 2)
+        self.assertIn('1 items migrated, 1 already existed', migration_status.progress)
+
+    @patch('app.get_cosmos_client')
+    @patch('app.fast_count')
+    def test_migrate_rejects_concurrent_migration(self, mock_count_items, mock_get_cosmos_client):
+        # Background tasks share one OS thread under gevent, so a second asyncio.run() would fail
+        config = {'endpoint': 'endpoint', 'key': 'key', 'database_name': 'database_name', 'container_name': 'container_name'}
+
+        with migration_lock, patch('app.socketio.emit') as mock_emit:
+            migrate(config, config, 5)
+            mock_count_items.assert_not_called()
+            self.assertIn('already running', migration_status.errors)
+            mock_emit.assert_called_once_with('update', {'errors': migration_status.errors})
+        self.assertFalse(migration_lock.locked())
+
+    @patch('app.get_aio_container')
+    @patch('app.get_aio_client')
+    @patch('app.get_cosmos_client')
+    @patch('app.get_container')
+    @patch('app.fast_count')
+    @patch('app.migrate_data_async')
+    def test_migrate_concurrent_greenlets(self, mock_migrate_data, mock_count_items, mock_get_container, mock_get_cosmos_client, mock_get_aio_client, mock_get_aio_container):
+        # Two migrations started together: one runs, the other is rejected instead of crashing
+        import gevent
+        # Counting yields to the other greenlet while the first migration holds the lock
+        mock_count_items.side_effect = lambda container: gevent.sleep(0) or 2
+        mock_migrate_data.side_effect = async_results([({'id': '1'}, True), ({'id': '2'}, True)])
+        config = {'endpoint': 'endpoint', 'key': 'key', 'database_name': 'database_name', 'container_name': 'container_name'}
+
+        with patch('app.socketio.emit'), patch('app.socketio.start_background_task') as mock_start_background_task:
+            gevent.joinall([gevent.spawn(migrate, config, config, 5) for _ in range(2)])
+            self.assertEqual(mock_count_items.call_count, 1)
+            self.assertIn('already running', migration_status.errors)
+            mock_start_background_task.assert_called_once()
+        self.assertFalse(migration_lock.locked())
+
+    @patch('app.socketio.start_background_task')
+    def test_index_post_while_migrating(self, mock_start_background_task):
+        with migration_lock:
+            response = self.app.post('/', data=self.form_data())
+        self.assertEqual(response.status_code, 409)
+        mock_start_background_task.assert_not_called()
+
+    def test_validate_data(self):
+        # Matching counts need no source reads
+        source = MagicMock()
+        destination = FakeContainer([{'id': str(i), 'pk': 'p'} for i in range(10)])
 
         with patch('app.socketio.emit') as mock_emit:
-            validate_data(source_container, destination_container)
-            self.assertEqual(migration_status['validation'], 'Data verification successful.')
-            mock_emit.assert_called()
+            validate_data(source, destination, 10)
+            self.assertEqual(source.method_calls, [])
+            self.assertEqual(migration_status.validation, 'Data verification successful.')
+            mock_emit.assert_called_once_with('update', {
+                'validation': 'Data verification successful.',
+                'not_migrated_items': []
+            })
+
+    def test_validate_data_missing_items(self):
+        source = FakeContainer([{'id': str(i), 'pk': 'p'} for i in range(1, 5)])
+        destination = FakeContainer([{'id': '1', 'pk': 'p'}, {'id': '3', 'pk': 'p'}])
+
+        with patch('app.socketio.emit'):
+            validate_data(source, destination, 4)
+            self.assertIn('2 of 4 source items are missing', migration_status.validation)
+            self.assertEqual(migration_status.not_migrated_items, [{'id': '2', 'partition_key': ['p']}, {'id': '4', 'partition_key': ['p']}])
+
+    def test_validate_data_same_id_in_another_partition(self):
+        # A destination item with the same id but another partition key is a different item
+        source = FakeContainer([{'id': 'a', 'pk': 'p2'}, {'id': 'b', 'pk': 'p1'}])
+        destination = FakeContainer([{'id': 'a', 'pk': 'p1'}])
+
+        with patch('app.socketio.emit'):
+            validate_data(source, destination, 2)
+            self.assertIn('2 of 2 source items are missing', migration_status.validation)
+            self.assertEqual(migration_status.not_migrated_items, [{'id': 'a', 'partition_key': ['p2']}, {'id': 'b', 'partition_key': ['p1']}])
+
+    def test_validate_data_destination_with_other_items(self):
+        # Items that were in the destination before the migration make the counts differ
+        source = FakeContainer([{'id': 'a', 'pk': 'p1'}])
+        destination = FakeContainer([{'id': 'a', 'pk': 'p1'}, {'id': 'b', 'pk': 'p1'}])
+
+        with patch('app.socketio.emit'):
+            validate_data(source, destination, 1)
+            self.assertEqual(migration_status.validation, 'Data verification successful.')
+
+    @patch('app.find_missing_items')
+    def test_validate_data_limits_listed_items(self, mock_find_missing_items):
+        mock_find_missing_items.return_value = (5000, 2000, [('1', (('str', 'p'),))])
+
+        with patch('app.socketio.emit'):
+            validate_data(MagicMock(), FakeContainer(), 5000)
+            self.assertIn('2000 of 5000 source items are missing', migration_status.validation)
+            self.assertIn('The first 1 are listed', migration_status.validation)
 
     def test_index_get(self):
         response = self.app.get('/')
@@ -80,5 +516,257 @@ class TestApp(unittest.TestCase):
         self.assertIn(b'<form', response.data)
         mock_start_background_task.assert_called()
 
+    @patch('app.socketio.start_background_task')
+    def test_index_post_invalid_batch_size(self, mock_start_background_task):
+        response = self.app.post('/', data={
+            'source_endpoint': 'source_endpoint',
+            'source_key': 'source_key',
+            'source_database_name': 'source_database_name',
+            'source_container_name': 'source_container_name',
+            'destination_endpoint': 'destination_endpoint',
+            'destination_key': 'destination_key',
+            'destination_database_name': 'destination_database_name',
+            'destination_container_name': 'destination_container_name',
+            'batch_size': 'five'
+        })
+        self.assertEqual(response.status_code, 400)
+        for batch_size in ('0', '-5'):
+            with self.subTest(batch_size=batch_size):
+                response = self.app.post('/', data=self.form_data(batch_size=batch_size))
+                self.assertEqual(response.status_code, 400)
+        mock_start_background_task.assert_not_called()
+
+    @patch('app.socketio.start_background_task')
+    def test_index_post_non_positive_target_ru_per_sec(self, mock_start_background_task):
+        for target_ru_per_sec in ('0', '-100'):
+            with self.subTest(target_ru_per_sec=target_ru_per_sec):
+                response = self.app.post('/', data=self.form_data(target_ru_per_sec=target_ru_per_sec))
+                self.assertEqual(response.status_code, 400)
+        mock_start_background_task.assert_not_called()
+
+class TestGetAioClient(unittest.TestCase):
+
+    def test_session_reads_proxy_settings_from_environment(self):
+        async def session_settings():
+            client = cosmos_data_migration_async.get_aio_client({'endpoint': 'https://localhost:8081/', 'key': 'a2V5'})
+            # Entering the client would connect, so only close it
+            session = client.client_connection.pipeline_client._pipeline._transport.session
+            settings = session.trust_env, session.connector.limit
+            await client.close()
+            return settings
+
+        self.assertEqual(asyncio.run(session_settings()), (True, cosmos_data_migration_async.MAX_CONCURRENCY))
+
+class BlockingCountContainer:
+    """
+    Container whose COUNT queries block until release is set. Each query returns the next
+    of results, raising it if it is an exception.
+    """
+    links = itertools.count()
+
+    def __init__(self, *results):
+        self.container_link = f'dbs/test/colls/blocking{next(self.links)}'
+        self.results = list(results)
+        self.queries = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def query_items(self, query, **kwargs):
+        self.queries += 1
+        self.started.set()
+        self.release.wait()
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return [result]
+
+class TestCountItems(unittest.TestCase):
+
+    def count_concurrently(self, container):
+        """
+        Count the container from two threads, the second starting while the first is querying.
+        Returns the count or exception of each thread.
+        """
+        outcomes = [None, None]
+
+        def count(index):
+            try:
+                outcomes[index] = cosmos_data_migration.count_items(container)
+            except Exception as e:
+                outcomes[index] = e
+
+        threads = [threading.Thread(target=count, args=(index,)) for index in range(2)]
+        threads[0].start()
+        container.started.wait()
+        threads[1].start()
+        # Let the second caller reach the wait for the first caller's query
+        time.sleep(0.05)
+        container.release.set()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_concurrent_callers_share_one_query(self):
+        container = BlockingCountContainer(42)
+
+        self.assertEqual(self.count_concurrently(container), [42, 42])
+        self.assertEqual(container.queries, 1)
+        # Later calls are served from the cache
+        self.assertEqual(cosmos_data_migration.count_items(container), 42)
+        self.assertEqual(container.queries, 1)
+
+    def test_waiter_takes_over_failed_query(self):
+        error = CosmosHttpResponseError(status_code=503, message='Service unavailable')
+        container = BlockingCountContainer(error, 42)
+
+        self.assertEqual(self.count_concurrently(container), [error, 42])
+        self.assertEqual(container.queries, 2)
+
+    def test_count_racing_with_writes_is_not_cached(self):
+        container = BlockingCountContainer(1, 2)
+        outcome = []
+        thread = threading.Thread(target=lambda: outcome.append(cosmos_data_migration.count_items(container)))
+        thread.start()
+        container.started.wait()
+        # Items are written while the count is in flight
+        cosmos_data_migration.forget_count(container)
+        container.release.set()
+        thread.join()
+
+        self.assertEqual(outcome, [1])
+        self.assertEqual(cosmos_data_migration.count_items(container), 2)
+        self.assertEqual(container.queries, 2)
+
+class TestFastCount(unittest.TestCase):
+
+    def container(self, resource_usage):
+        """
+        Return a fake container whose quota read responds with the given x-ms-resource-usage.
+        """
+        container = FakeContainer([{'id': str(n), 'pk': 'p'} for n in range(3)])
+        container.client_connection = MagicMock(last_response_headers={'x-ms-resource-usage': resource_usage} if resource_usage is not None else {})
+        return container
+
+    def test_documents_count_from_quota_usage(self):
+        container = self.container('documentSize=1;documentsCount=1234;collectionSize=5')
+
+        with patch('cosmos_data_migration.count_items') as mock_count_items:
+            self.assertEqual(cosmos_data_migration.fast_count(container), 1234)
+            mock_count_items.assert_not_called()
+
+    def test_missing_documents_count_falls_back_to_query(self):
+        for resource_usage in ('documentSize=1;collectionSize=5', None):
+            with self.subTest(resource_usage=resource_usage):
+                self.assertEqual(cosmos_data_migration.fast_count(self.container(resource_usage)), 3)
+
+    def test_failed_quota_read_falls_back_to_query(self):
+        container = self.container(None)
+        container.read = MagicMock(side_effect=CosmosHttpResponseError(status_code=500, message='Internal error'))
+
+        self.assertEqual(cosmos_data_migration.fast_count(container), 3)
+
+class TestWorkersForThroughput(unittest.TestCase):
+
+    def container(self, offer_throughput=None, auto_scale_max_throughput=None):
+        container = MagicMock()
+        container.get_throughput.return_value = MagicMock(offer_throughput=offer_throughput, auto_scale_max_throughput=auto_scale_max_throughput)
+        return container
+
+    def test_manual_throughput(self):
+        self.assertEqual(cosmos_data_migration.workers_for_throughput(self.container(offer_throughput=1000)), 100)
+
+    def test_autoscale_uses_maximum_throughput(self):
+        self.assertEqual(cosmos_data_migration.workers_for_throughput(self.container(offer_throughput=400, auto_scale_max_throughput=2000)), 200)
+
+    def test_worker_count_is_bounded(self):
+        self.assertEqual(cosmos_data_migration.workers_for_throughput(self.container(offer_throughput=10)), cosmos_data_migration.MIN_WORKERS)
+        self.assertEqual(cosmos_data_migration.workers_for_throughput(self.container(offer_throughput=100000)), cosmos_data_migration.MAX_WORKERS)
+
+    def test_no_dedicated_throughput_falls_back_to_default(self):
+        # Containers on shared database throughput or serverless accounts have no offer
+        container = MagicMock()
+        container.get_throughput.side_effect = CosmosResourceNotFoundError(status_code=404, message='Throughput is not configured')
+
+        self.assertEqual(cosmos_data_migration.workers_for_throughput(container), cosmos_data_migration.DEFAULT_WORKERS)
+
+@unittest.skipIf(fast_json.orjson is None, "orjson is not installed")
+class TestFastJson(unittest.TestCase):
+
+    def assert_matches_json(self, value, **kwargs):
+        self.assertEqual(fast_json.dumps(value, separators=(',', ':'), **kwargs), json.dumps(value, separators=(',', ':'), **kwargs))
+
+    def test_non_ascii_strings(self):
+        self.assert_matches_json({'name': 'h\u00e9llo \u2603 \U0001f600'})
+        self.assert_matches_json({'name': 'h\u00e9llo \u2603 \U0001f600'}, ensure_ascii=False)
+
+    def test_values_orjson_rejects(self):
+        # Integers beyond 64 bits and non-string keys make orjson raise
+        self.assert_matches_json({'count': 2 ** 70})
+        self.assert_matches_json({1: 2})
+
+    def test_nulls_use_orjson(self):
+        # Null fields are common in documents, so they must not cost a second serialization
+        document = {'id': 'a', 'nullable': None, 'tags': ['null', None], 'ratio': 0.5}
+        self.assert_matches_json(document)
+        with patch('fast_json.json.dumps') as mock_dumps:
+            fast_json.dumps(document, separators=(',', ':'))
+            mock_dumps.assert_not_called()
+
+    def test_other_separators_use_json(self):
+        self.assertEqual(fast_json.dumps({'a': 1}), json.dumps({'a': 1}))
+
+class TestThroughputController(unittest.TestCase):
+
+    def setUp(self):
+        self.time = patch('cosmos_data_migration_async.time').start()
+        self.sleep = patch('cosmos_data_migration_async.asyncio.sleep').start()
+        self.time.monotonic.return_value = 0.0
+
+    def tearDown(self):
+        patch.stopall()
+
+    def run_batch(self, controller, request_charge, elapsed, throttled=False):
+        """
+        Record request_charge RU spent over elapsed seconds, then start the next batch.
+        """
+        # The SDK reports the 429s it retried internally on the response that finally succeeded
+        controller.record_charge({'x-ms-request-charge': str(request_charge), 'x-ms-throttle-retry-count': '2' if throttled else '0'}, None)
+        self.time.monotonic.return_value += elapsed
+        asyncio.run(controller.next_batch())
+        return self.sleep.await_args.args[0]
+
+    def test_over_budget_shrinks_batch_and_waits(self):
+        controller = cosmos_data_migration_async.ThroughputController(100, 100)
+
+        delay = self.run_batch(controller, 500, 1.0)
+
+        # 500 RU/s against a budget of 100 RU/s: a fifth of the batch, and 4s more to pay for it
+        self.assertEqual(controller.batch_size, 20)
+        self.assertAlmostEqual(delay, 4.0)
+
+    def test_under_budget_grows_batch_without_waiting(self):
+        controller = cosmos_data_migration_async.ThroughputController(100, 100)
+
+        delay = self.run_batch(controller, 50, 1.0)
+
+        self.assertEqual(controller.batch_size, 200)
+        self.assertEqual(delay, 0.0)
+
+    def test_throttle_retries_mark_batch_as_throttled(self):
+        controller = cosmos_data_migration_async.ThroughputController(100, 100)
+
+        controller.record_charge({'x-ms-request-charge': '10'}, None)
+        self.assertFalse(controller.throttled)
+        controller.record_charge({'x-ms-request-charge': '10', 'x-ms-throttle-retry-count': '1'}, None)
+        self.assertTrue(controller.throttled)
+
+    def test_throttling_doubles_backoff_until_it_stops(self):
+        controller = cosmos_data_migration_async.ThroughputController(100, 100)
+
+        delays = [self.run_batch(controller, 100, 1.0, throttled) for throttled in (True, True, True, False)]
+
+        self.assertEqual([round(delay, 3) for delay in delays], [0.1, 0.2, 0.4, 0.2])
+        self.assertEqual(controller.batch_size, 100)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file